@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 import argparse
+import base64
+import email.utils
+import functools
+import hashlib
+import http.client
 import json
 import os
+import random
+import re
 import sys
-import urllib.error
+import threading
+import time
 import urllib.parse
 import urllib.request
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # The event types that Datadog's Source Code Integration requires
 EVENT_TYPES = [
@@ -34,6 +44,44 @@ EVENT_TYPE_VERSIONS = {
     "git.push": VERSION_1_0,
 }
 
+# Number of concurrent API calls used when configuring or deleting service hooks
+MAX_WORKERS = 8
+
+# Timeout in seconds for a single HTTP request
+HTTP_TIMEOUT = 60
+
+# Requests that can be safely resent if a reused keep-alive connection turns out to be closed
+IDEMPOTENT_METHODS = ("GET", "DELETE")
+
+# Keep-alive connections idle for longer than this are reopened before sending a non-idempotent request,
+# which can't be resent if the server closed the connection in the meantime
+KEEPALIVE_IDLE_TIMEOUT = 5
+
+# Throttled requests (HTTP 429 / 503) are retried with backoff, honoring the Retry-After header
+RETRYABLE_STATUS_CODES = (429, 503)
+MAX_ATTEMPTS = 5
+MAX_RETRY_DELAY = 300
+
+# Maximum number of projects filtered on in a single service hooks query
+HOOKS_QUERY_BATCH_SIZE = 50
+
+# Maximum number of projects returned per page when listing projects
+PROJECTS_PAGE_SIZE = 1000
+
+# Minimum number of seconds between two redraws of the progress bar
+PROGRESS_INTERVAL = 0.1
+
+# Projects and service hooks are cached on disk to speed up repeated runs
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "azdevops-sci-hooks",
+)
+PROJECTS_CACHE_TTL = 15 * 60
+HOOKS_CACHE_TTL = 60
+
+# Azure DevOps organization slugs are used as a URL path segment and as a cache directory name
+AZ_DEVOPS_ORG_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]*")
+
 VALID_DD_SITES = [
     "datadoghq.com",
     "datadoghq.eu",
@@ -59,11 +107,13 @@ def main():
         type=str,
         help="Datadog site to use",
         choices=VALID_DD_SITES,
+        required=True,
     )
     parser.add_argument(
         "-o",
         "--az-devops-org",
-        type=str,
+        type=az_devops_org,
+        required=True,
         help="Azure DevOps organization on which service hooks will be configured, The path segment after dev.azure.com/ in your organization URL.",
     )
     parser.add_argument(
@@ -79,6 +129,19 @@ def main():
         default=False,
         action="store_true",
     )
+    parser.add_argument(
+        "-y",
+        "--yes",
+        help="Do not prompt for confirmation before configuring or uninstalling service hooks, e.g. when running in CI",
+        default=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no-cache",
+        help=f"Do not read or write the projects and service hooks cache in {CACHE_DIR}",
+        default=False,
+        action="store_true",
+    )
     parser.add_argument(
         "--project",
         help="Specify a project to interact with. This will scope the installation to a single project in your Azure DevOps organization.",
@@ -88,46 +151,64 @@ def main():
     args = parser.parse_args()
 
     # Check env vars are set correctly
-    az_devops_token = os.getenv("AZURE_DEVOPS_TOKEN")
-    if az_devops_token is None or az_devops_token == "":
+    az_devops_token = os.environ.get("AZURE_DEVOPS_TOKEN") or None
+    if not az_devops_token:
         print("AZURE_DEVOPS_TOKEN is not set in your environment.")
-        exit(1)
+        sys.exit(1)
 
-    dd_api_key = os.getenv("DD_API_KEY")
+    dd_api_key = os.environ.get("DD_API_KEY") or None
     # we only need the DD_API_KEY to install, not uninstall
-    if not args.uninstall and (dd_api_key is None or dd_api_key == ""):
+    if not args.uninstall and not dd_api_key:
         print("DD_API_KEY is not set in your environment.")
-        exit(1)
+        sys.exit(1)
 
-    client = Client(
+    with Client(
         args.az_devops_org,
         az_devops_token,
         args.dd_site,
         dd_api_key,
         args.verbose,
         args.project,
-    )
+        use_cache=not args.no_cache,
+        assume_yes=args.yes,
+    ) as client:
+        try:
+            if args.uninstall:
+                exit_code = client.uninstall_hooks()
+            else:
+                exit_code = client.install_hooks()
+
+        except AzureDevOpsException as e:
+            if (
+                e.response.status_code == 401
+                or e.response.status_code == 403
+                or e.response.status_code == 203  # 203 is used for the login redirect
+                # Redirects aren't followed, Azure DevOps only redirects API calls to its sign-in page
+                or 300 <= e.response.status_code < 400
+            ):
+                print(
+                    "Invalid Azure DevOps token! Please check that your Azure DevOps token is valid and has admin access to the organization."
+                )
+            elif e.is_retryable:
+                print(
+                    f"{e.response.status_code} error from Azure DevOps API, the service may be throttling requests. Please try again later: {e.response.text}"
+                )
+            else:
+                print(
+                    f"{e.response.status_code} error from Azure DevOps API: {e.response.text}"
+                )
+            sys.exit(1)
 
-    try:
-        if args.uninstall:
-            client.uninstall_hooks()
-        else:
-            client.install_hooks()
+    sys.exit(exit_code)
 
-    except AzureDevOpsException as e:
-        if (
-            e.response.status_code == 401
-            or e.response.status_code == 403
-            or e.response.status_code == 203  # 203 is used for the login redirect
-        ):
-            print(
-                "Invalid Azure DevOps token! Please check that your Azure DevOps token is valid and has admin access to the organization."
-            )
-        else:
-            print(
-                f"{e.response.status_code} error from Azure DevOps API: {e.response.text}"
-            )
-        exit(1)
+
+def az_devops_org(value):
+    """argparse type for --az-devops-org, rejecting values that aren't a single URL path segment."""
+    if not AZ_DEVOPS_ORG_PATTERN.fullmatch(value):
+        raise argparse.ArgumentTypeError(
+            f"invalid organization {value!r}, expected the path segment after dev.azure.com/ in your organization URL"
+        )
+    return value
 
 
 class Client:
@@ -139,6 +220,8 @@ class Client:
         dd_api_key,
         verbose=True,
         project=None,
+        use_cache=True,
+        assume_yes=False,
     ):
         self.az_devops_token = az_devops_token
         self.az_devops_org = az_devops_org
@@ -146,44 +229,94 @@ class Client:
         self.dd_api_key = dd_api_key
         self.verbose = verbose
         self.project = project
+        self.use_cache = use_cache
+        self.assume_yes = assume_yes
+        # Values derived from the immutable settings above, computed once instead of on every request
+        self._az_base_url = f"https://dev.azure.com/{az_devops_org}"
+        self._webhook_url = f"https://webhook-intake.{dd_site}/api/v2/webhook"
+        self._az_auth_headers = MappingProxyType(
+            {"Authorization": f"Bearer {az_devops_token}"}
+        )
+        self._az_json_headers = MappingProxyType(
+            {**self._az_auth_headers, "Content-Type": "application/json"}
+        )
+        self._subscriptions_url = (
+            f"{self._az_base_url}/_apis/hooks/subscriptions?api-version=7.1"
+        )
+        # Service hook subscription payload, serialized once. The placeholders are substituted per hook
+        # with project IDs (GUIDs) and known event types, none of which need JSON escaping.
+        self._hook_payload_template = json.dumps(
+            {
+                "publisherId": "__PUB__",
+                "eventType": "__EVT__",
+                "resourceVersion": "__RV__",
+                "publisherInputs": {
+                    "projectId": "__PID__",
+                },
+                "consumerId": "webHooks",
+                "consumerActionId": "httpRequest",
+                "consumerInputs": {
+                    "url": self._webhook_url,
+                    "httpHeaders": f"dd-api-key: {dd_api_key}",
+                },
+            }
+        ).encode("utf-8")
+        self._print_lock = threading.Lock()
+        self._last_progress = 0.0
+        # Keep-alive connections, one per host and per thread since http.client connections are not thread-safe
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # Shared by every fan-out so that worker threads, and their keep-alive connections, live for the whole run
+        self._executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        # Set once the run is failing, so in-flight requests stop retrying
+        self._aborting = threading.Event()
 
     def install_hooks(self):
-        self.validate_dd_api_key()
+        """Configure the missing service hooks, returning the process exit code."""
+        # Validate the Datadog API key while listing projects and hooks, its result is checked before returning
+        dd_api_key_validation = self._executor.submit(self.validate_dd_api_key)
 
-        projects = self.list_projects()
-
-        if self.project is not None:
-            projects = [p for p in projects if p["name"] == self.project]
+        if self.project is None:
+            projects = self.list_projects()
+        else:
+            project = self.get_project(self.project)
+            projects = [] if project is None else [project]
 
         if len(projects) == 0:
+            dd_api_key_validation.result()
             if self.project is None:
                 print(f"No projects found in {self.az_devops_org}.")
             else:
                 print(f"Project {self.project} not found in {self.az_devops_org}")
-            return
+                return 1
+            return 0
 
-        existing_hooks_by_project_type = {
-            (hook["publisherInputs"]["projectId"], hook["eventType"]): hook
-            for hook in self.get_existing_hooks()
+        existing_hooks = {
+            (hook["publisherInputs"]["projectId"], hook["eventType"])
+            for hook in self.get_existing_hooks([project["id"] for project in projects])
         }
 
-        toProcess = []
-        numProjectsMissingAtLeastOne = 0
-        for project in projects:
-            missingAtLeastOne = False
-            for event_type in EVENT_TYPES:
-                if (project["id"], event_type) not in existing_hooks_by_project_type:
-                    toProcess += [(project, event_type)]
-                    missingAtLeastOne = True
-                else:
-                    self.verbose_print(
-                        f"{event_type} service hook is already configured for project {project['name']}"
-                    )
-
-            if missingAtLeastOne:
-                numProjectsMissingAtLeastOne += 1
+        toProcess = [
+            (project, event_type)
+            for project in projects
+            for event_type in EVENT_TYPES
+            if (project["id"], event_type) not in existing_hooks
+        ]
+        numProjectsMissingAtLeastOne = len({project["id"] for project, _ in toProcess})
+
+        if self.verbose:
+            for project in projects:
+                for event_type in EVENT_TYPES:
+                    if (project["id"], event_type) in existing_hooks:
+                        self.verbose_print(
+                            "%s service hook is already configured for project %s",
+                            event_type,
+                            project["name"],
+                        )
 
         if len(toProcess) == 0:
+            dd_api_key_validation.result()
             if self.project is None:
                 print(
                     f"All {len(projects)} projects in {self.az_devops_org} already have Datadog service hooks correctly configured!"
@@ -192,25 +325,40 @@ class Client:
                 print(
                     f"The project {self.project} already has Datadog service hooks correctly configured!"
                 )
-            return
+            return 0
+
+        dd_api_key_validation.result()
 
         # Prompt confirmation for batch setup
         if self.project is None:
-            yesno = input(
+            if not self._confirm(
                 f"{numProjectsMissingAtLeastOne} of {len(projects)} projects in {self.az_devops_org} are missing at least one service hook.\nPlease confirm that you want to configure service hooks for these {numProjectsMissingAtLeastOne} projects (yes/no): "
-            )
-            if yesno.lower() not in ["yes", "y"]:
+            ):
                 print("Exiting.")
-                exit(1)
-
-        for i, (project, event_type) in enumerate(toProcess):
-            progress(
-                i + 1,
-                len(toProcess),
-                prefix="Configuring service hooks",
-                suffix=f"{project['name']} - {event_type}",
-            )
-            self.configure_service_hook(project, event_type)
+                return 1
+
+        try:
+            futures = {
+                self._executor.submit(
+                    self.configure_service_hook, project, event_type
+                ): (project, event_type)
+                for project, event_type in toProcess
+            }
+            for i, future in enumerate(as_completed(futures)):
+                future.result()
+                project, event_type = futures[future]
+                self._progress(
+                    i + 1,
+                    len(toProcess),
+                    prefix="Configuring service hooks",
+                    suffix=f"{project['name']} - {event_type}",
+                )
+        except BaseException:
+            # Includes KeyboardInterrupt while waiting in as_completed
+            self._abort()
+            raise
+        finally:
+            self._cache_clear("hooks")
 
         if self.project is None:
             print(
@@ -220,96 +368,186 @@ class Client:
             print(
                 f"\nSuccessfully configured {len(toProcess)} service hooks in project {self.project}!"
             )
+        return 0
 
     def uninstall_hooks(self):
+        """Delete all Datadog service hooks, returning the process exit code."""
         if self.project is not None:
             print(
                 "Specifying a single project is not supported for the uninstallation command."
             )
-            return
+            return 1
 
         hooks = self.get_existing_hooks()
 
         if len(hooks) == 0:
             print("No Datadog service hooks found.")
-            return
+            return 0
 
-        project_count = len({hook["publisherInputs"]["projectId"] for hook in hooks})
+        project_ids = set()
+        for hook in hooks:
+            project_ids.add(hook["publisherInputs"]["projectId"])
+        project_count = len(project_ids)
         print(
             f"Found {len(hooks)} Datadog service hooks among {project_count} projects in {self.az_devops_org}."
         )
-        yesno = input(
-            f"Are you sure you want to uninstall these {project_count} Datadog service hooks ? This will break the integration with Datadog. (yes/no): "
-        )
-        if yesno.lower() not in ["yes", "y"]:
+        if not self._confirm(
+            f"Are you sure you want to uninstall these {len(hooks)} Datadog service hooks ? This will break the integration with Datadog. (yes/no): "
+        ):
             print("Exiting.")
-            exit(1)
-
-        for i, hook in enumerate(hooks):
-            progress(
-                i + 1,
-                len(hooks),
-                prefix="Uninstalling service hooks",
-                suffix=f"{hook['publisherInputs']['projectId']} - {hook['eventType']}",
-            )
-            self.delete_service_hook(hook)
+            return 1
+
+        try:
+            futures = {
+                self._executor.submit(self.delete_service_hook, hook): hook
+                for hook in hooks
+            }
+            for i, future in enumerate(as_completed(futures)):
+                future.result()
+                hook = futures[future]
+                self._progress(
+                    i + 1,
+                    len(hooks),
+                    prefix="Uninstalling service hooks",
+                    suffix=f"{hook['publisherInputs']['projectId']} - {hook['eventType']}",
+                )
+        except BaseException:
+            # Includes KeyboardInterrupt while waiting in as_completed
+            self._abort()
+            raise
+        finally:
+            self._cache_clear("hooks")
 
         print(
             f"\nSuccessfully uninstalled {len(hooks)} Datadog service hooks among {project_count} projects in {self.az_devops_org}!"
         )
+        return 0
 
-    def list_projects(self, continuation_token=None):
-        base_url = f"{self._az_base_url()}/_apis/projects"
-        params = {"api-version": "7.1"}
-        if continuation_token:
-            params = {"continuationToken": continuation_token}
-
-        url = f"{base_url}?{urllib.parse.urlencode(params)}"
-        req = urllib.request.Request(url, headers=self._az_auth_headers())
+    def _confirm(self, prompt):
+        if self.assume_yes:
+            return True
         try:
-            with urllib.request.urlopen(req) as response:
-                if response.status != 200:
-                    raise AzureDevOpsException(
-                        "Error listing Azure DevOps projects", response
-                    )
-                data = json.loads(response.read().decode())
-        except urllib.error.HTTPError as e:
-            raise AzureDevOpsException("Error listing Azure DevOps projects", e) from e
-        projects = data["value"]
-        continuation_token = data.get("continuation_token")
-        if continuation_token:
-            projects += self.list_projects(continuation_token)
+            yesno = input(prompt)
+        except EOFError:
+            # stdin is closed or not interactive, e.g. in CI
+            print("\nNo confirmation received, use --yes to skip this prompt.")
+            return False
+        return yesno.lower() in ["yes", "y"]
+
+    def list_projects(self):
+        projects = self._cache_get("projects", PROJECTS_CACHE_TTL)
+        if projects is not None:
+            return projects
+
+        base_url = f"{self._az_base_url}/_apis/projects"
+        projects = []
+        continuation_token = None
+        while True:
+            params = {"api-version": "7.1", "$top": PROJECTS_PAGE_SIZE}
+            if continuation_token:
+                params["continuationToken"] = continuation_token
+
+            url = f"{base_url}?{urllib.parse.urlencode(params)}"
+            response = self._request("GET", url, headers=self._az_auth_headers)
+            if response.status_code != 200:
+                raise AzureDevOpsException(
+                    "Error listing Azure DevOps projects", response
+                )
+            data = json.loads(response.data)
+            projects.extend(data["value"])
+            # The continuation token is returned as a response header, not in the body
+            continuation_token = response.headers.get("x-ms-continuationtoken")
+            if not continuation_token:
+                break
+
+        self._cache_set("projects", projects)
         return projects
 
-    def get_existing_hooks(self):
-        url = f"{self._az_base_url()}/_apis/hooks/subscriptionsquery?api-version=7.1"
-        payload = json.dumps(
-            {
-                "consumerId": "webHooks",
-                "consumerInputFilters": [
-                    {
-                        "conditions": [
-                            {
-                                "inputId": "url",
-                                "inputValue": self._webhook_url(),
-                                "operator": "equals",
-                            }
-                        ]
-                    }
-                ],
-            }
-        ).encode("utf-8")
-        headers = self._az_auth_headers()
-        headers["Content-Type"] = "application/json"
-        req = urllib.request.Request(url, headers=headers, data=payload, method="POST")
-        try:
-            with urllib.request.urlopen(req) as response:
-                if response.status != 200:
-                    raise AzureDevOpsException("Error listing service hooks", response)
-                data = json.loads(response.read().decode())
-        except urllib.error.HTTPError as e:
-            raise AzureDevOpsException("Error listing service hooks", e) from e
-        return data["results"]
+    def get_project(self, name):
+        """Fetch a single project by name or ID, returning None if it doesn't exist."""
+        url = f"{self._az_base_url}/_apis/projects/{urllib.parse.quote(name, safe='')}?api-version=7.1"
+        response = self._request("GET", url, headers=self._az_auth_headers)
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise AzureDevOpsException(
+                f"Error fetching Azure DevOps project {name}", response
+            )
+        return json.loads(response.data)
+
+    def get_existing_hooks(self, project_ids=None):
+        """List Datadog service hooks, restricted to the given projects when project_ids is set."""
+        # Hooks are filtered on the webhook URL, which depends on the Datadog site
+        cache_key = f"hooks-{self.dd_site}"
+        if project_ids is not None:
+            digest = hashlib.sha256(",".join(sorted(project_ids)).encode()).hexdigest()
+            cache_key = f"{cache_key}-{digest[:16]}"
+        hooks = self._cache_get(cache_key, HOOKS_CACHE_TTL)
+        if hooks is not None:
+            return hooks
+
+        if project_ids is None:
+            hooks = self._query_hooks()
+        else:
+            batches = [
+                project_ids[i : i + HOOKS_QUERY_BATCH_SIZE]
+                for i in range(0, len(project_ids), HOOKS_QUERY_BATCH_SIZE)
+            ]
+            hooks = [
+                hook
+                for batch in self._executor.map(self._query_hooks, batches)
+                for hook in batch
+            ]
+            # Guard against the server ignoring the project filter
+            wanted = set(project_ids)
+            hooks = [
+                hook
+                for hook in hooks
+                if hook["publisherInputs"]["projectId"] in wanted
+            ]
+
+        self._cache_set(cache_key, hooks)
+        return hooks
+
+    def _query_hooks(self, project_ids=None):
+        url = f"{self._az_base_url}/_apis/hooks/subscriptionsquery?api-version=7.1"
+        query = {
+            "consumerId": "webHooks",
+            "consumerInputFilters": [
+                {
+                    "conditions": [
+                        {
+                            "inputId": "url",
+                            "inputValue": self._webhook_url,
+                            "operator": "equals",
+                        }
+                    ]
+                }
+            ],
+        }
+        if project_ids is not None:
+            # Conditions within a single input filter are ORed together
+            query["publisherInputFilters"] = [
+                {
+                    "conditions": [
+                        {
+                            "inputId": "projectId",
+                            "inputValue": project_id,
+                            "operator": "equals",
+                        }
+                        for project_id in project_ids
+                    ]
+                }
+            ]
+        payload = json.dumps(query).encode("utf-8")
+        # The query is read-only, it can be resent safely
+        response = self._request(
+            "POST", url, headers=self._az_json_headers, body=payload, idempotent=True
+        )
+        if response.status_code != 200:
+            raise AzureDevOpsException("Error listing service hooks", response)
+        data = json.loads(response.data)
+        return [_hook_summary(hook) for hook in data["results"]]
 
     def _get_publisher_id(self, event_type):
         """Get the correct publisher ID for a given event type."""
@@ -320,89 +558,205 @@ class Client:
 
     def configure_service_hook(self, project, event_type):
         self.verbose_print(
-            f"Configuring {event_type} service hook for project {project['name']}..."
+            "Configuring %s service hook for project %s...",
+            event_type,
+            project["name"],
         )
-        url = f"{self._az_base_url()}/_apis/hooks/subscriptions?api-version=7.1"
         publisher_id = self._get_publisher_id(event_type)
         resource_version = EVENT_TYPE_VERSIONS.get(event_type, DEFAULT_RESOURCE_VERSION)
-        payload = json.dumps(
-            {
-                "publisherId": publisher_id,
-                "eventType": event_type,
-                "resourceVersion": resource_version,
-                "consumerId": "webHooks",
-                "consumerActionId": "httpRequest",
-                "publisherInputs": {
-                    "projectId": project["id"],
-                },
-                "consumerInputs": {
-                    "url": self._webhook_url(),
-                    "httpHeaders": "dd-api-key: " + self.dd_api_key,
-                },
-            }
-        ).encode("utf-8")
-        headers = self._az_auth_headers()
-        headers["Content-Type"] = "application/json"
-        req = urllib.request.Request(url, headers=headers, data=payload, method="POST")
-        try:
-            with urllib.request.urlopen(req) as response:
-                if response.status != 200:
-                    raise AzureDevOpsException(
-                        f"Error configuring service hook for project {project['name']}",
-                        response,
-                    )
-        except urllib.error.HTTPError as e:
+        payload = (
+            self._hook_payload_template.replace(b"__PUB__", publisher_id.encode(), 1)
+            .replace(b"__EVT__", event_type.encode(), 1)
+            .replace(b"__RV__", resource_version.encode(), 1)
+            .replace(b"__PID__", project["id"].encode(), 1)
+        )
+        response = self._request(
+            "POST", self._subscriptions_url, headers=self._az_json_headers, body=payload
+        )
+        if response.status_code != 200:
             raise AzureDevOpsException(
                 f"Error configuring service hook for project {project['name']}",
-                e,
-            ) from e
+                response,
+            )
 
     def delete_service_hook(self, hook):
         self.verbose_print(
-            f"Removing {hook['eventType']} service hook for project {hook['publisherInputs']['projectId']}..."
+            "Removing %s service hook for project %s...",
+            hook["eventType"],
+            hook["publisherInputs"]["projectId"],
         )
-        url = f"{self._az_base_url()}/_apis/hooks/subscriptions/{hook['id']}?api-version=7.1"
-        req = urllib.request.Request(
-            url, headers=self._az_auth_headers(), method="DELETE"
-        )
-        try:
-            with urllib.request.urlopen(req) as response:
-                if response.status != 204:
-                    raise AzureDevOpsException(
-                        f"Error deleting service hook {hook['id']}", response
-                    )
-        except urllib.error.HTTPError as e:
-            if e.code != 204:
-                raise AzureDevOpsException(
-                    f"Error deleting service hook {hook['id']}", e
-                ) from e
-
-    def _az_auth_headers(self):
-        return {"Authorization": f"Bearer {self.az_devops_token}"}
-
-    def _az_base_url(self):
-        return f"https://dev.azure.com/{self.az_devops_org}"
-
-    def _webhook_url(self):
-        return f"https://webhook-intake.{self.dd_site}/api/v2/webhook"
+        url = f"{self._az_base_url}/_apis/hooks/subscriptions/{hook['id']}?api-version=7.1"
+        response = self._request("DELETE", url, headers=self._az_auth_headers)
+        if response.status_code != 204:
+            raise AzureDevOpsException(
+                f"Error deleting service hook {hook['id']}", response
+            )
 
     def validate_dd_api_key(self):
         url = f"https://api.{self.dd_site}/api/v1/validate"
-        req = urllib.request.Request(url, headers={"DD-API-KEY": self.dd_api_key})
-        try:
-            with urllib.request.urlopen(req) as response:
-                if response.status != 200:
-                    raise Exception(
-                        f"Invalid Datadog API key! Please check your Datadog site and API key.\n{response.status} {response.read().decode()}"
-                    )
-        except urllib.error.HTTPError as e:
+        response = self._request("GET", url, headers={"DD-API-KEY": self.dd_api_key})
+        if response.status_code != 200:
             raise Exception(
-                f"Error validating Datadog API key! \n{e.code} {e.read().decode()}"
-            ) from e
+                f"Invalid Datadog API key! Please check your Datadog site and API key.\n{response.status_code} {response.text}"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # The run is failing, don't wait for in-flight requests to work through their retries
+            self._abort()
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=not self._aborting.is_set())
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+
+    def _abort(self):
+        """Stop spending API quota once the run is failing: drop queued calls and stop retrying in-flight ones."""
+        self._aborting.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _cache_path(self, key):
+        return os.path.join(CACHE_DIR, self.az_devops_org, f"{key}.json")
+
+    def _cache_get(self, key, ttl_seconds):
+        """Return the cached value for key, or None if caching is disabled, it is missing or older than ttl_seconds."""
+        if not self.use_cache:
+            return None
+        path = self._cache_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > ttl_seconds:
+                return None
+            with open(path, encoding="utf-8") as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self.verbose_print("Using cached %s from %s", key, path)
+        return value
+
+    def _cache_set(self, key, value):
+        if not self.use_cache:
+            return
+        path = self._cache_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            # Write to a temporary file first so concurrent runs never read a partial cache entry
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self.verbose_print("Could not write cache %s: %s", path, e)
+
+    def _cache_clear(self, prefix):
+        cache_dir = os.path.dirname(self._cache_path(prefix))
+        try:
+            names = os.listdir(cache_dir)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(prefix):
+                try:
+                    os.remove(os.path.join(cache_dir, name))
+                except OSError:
+                    pass
+
+    def _request(self, method, url, headers, body=None, idempotent=None):
+        """Perform an HTTP request, backing off and retrying while the server is throttling."""
+        # Callers set idempotent for read-only POST queries
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        for attempt in range(MAX_ATTEMPTS):
+            response = self._send(method, url, headers, body, idempotent)
+            if not response.is_retryable or attempt == MAX_ATTEMPTS - 1:
+                return response
+            delay = _retry_delay(response, attempt)
+            self.verbose_print(
+                "Received %d for %s %s, retrying in %.1fs...",
+                response.status_code,
+                method,
+                url,
+                delay,
+            )
+            # Sleeps like time.sleep, but gives up as soon as the run is aborted
+            if self._aborting.wait(delay):
+                return response
+
+    def _send(self, method, url, headers, body, idempotent):
+        """Perform an HTTP request over a reused keep-alive connection and buffer its response."""
+        parsed = urllib.parse.urlsplit(url)
+        path = f"{parsed.path}?{parsed.query}" if parsed.query else parsed.path
+        connection = self._get_connection(parsed.netloc)
+        last_used = self._local.last_used
+        if (
+            not idempotent
+            and time.monotonic() - last_used.get(parsed.netloc, 0) > KEEPALIVE_IDLE_TIMEOUT
+        ):
+            connection.close()
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            connection.close()
+            # The server may have processed the request before dropping the connection, only resend when that's harmless
+            if not idempotent:
+                raise
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+        data = response.read()
+        last_used[parsed.netloc] = time.monotonic()
+        return Response(response.status, response.headers, data)
+
+    def _get_connection(self, host):
+        connections = getattr(self._local, "connections", None)
+        if connections is None:
+            connections = self._local.connections = {}
+            self._local.last_used = {}
+        connection = connections.get(host)
+        if connection is None:
+            connection = connections[host] = _https_connection(host)
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _progress(self, iteration, total, prefix, suffix):
+        """Redraw the progress bar at most every PROGRESS_INTERVAL seconds, always drawing the last iteration."""
+        now = time.monotonic()
+        if iteration != total and now - self._last_progress < PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        with self._print_lock:
+            progress(iteration, total, prefix=prefix, suffix=suffix)
 
-    def verbose_print(self, *args, **kwargs):
+    def verbose_print(self, message, *args):
+        """Print message when running verbose, %-formatting it with args only in that case, like logging does."""
         if self.verbose:
-            print(*args, **kwargs)
+            if args:
+                message = message % args
+            with self._print_lock:
+                print(message)
+
+
+class Response:
+    """Buffered HTTP response, exposing the attributes used by AzureDevOpsException."""
+
+    def __init__(self, status_code, headers, data):
+        self.status_code = status_code
+        self.headers = headers
+        self.data = data
+
+    @property
+    def text(self):
+        return self.data.decode("utf-8", errors="replace")
+
+    @property
+    def is_retryable(self):
+        return self.status_code in RETRYABLE_STATUS_CODES
 
 
 class AzureDevOpsException(Exception):
@@ -410,15 +764,71 @@ class AzureDevOpsException(Exception):
         self.message = message
         self.response = response
 
+    @property
+    def is_retryable(self):
+        """Whether the error is throttling that Client._request retried, rather than a terminal error."""
+        return self.response.is_retryable
+
     def __str__(self):
         return f"{self.message}: {self.response.status_code} {self.response.text}"
 
 
+def _https_connection(host):
+    """HTTPS connection to host, tunneled through the HTTPS proxy from the environment if one applies."""
+    proxy = urllib.request.getproxies().get("https")
+    if not proxy or urllib.request.proxy_bypass(host):
+        return http.client.HTTPSConnection(host, timeout=HTTP_TIMEOUT)
+
+    parsed = urllib.parse.urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+    tunnel_headers = {}
+    if parsed.username is not None:
+        credentials = f"{urllib.parse.unquote(parsed.username)}:{urllib.parse.unquote(parsed.password or '')}"
+        tunnel_headers["Proxy-Authorization"] = (
+            f"Basic {base64.b64encode(credentials.encode()).decode()}"
+        )
+    connection = http.client.HTTPSConnection(
+        parsed.hostname, parsed.port or 80, timeout=HTTP_TIMEOUT
+    )
+    connection.set_tunnel(host, headers=tunnel_headers)
+    return connection
+
+
+def _hook_summary(hook):
+    """Keep only the service hook fields this script uses, so secrets in consumerInputs are never cached on disk."""
+    return {
+        "id": hook["id"],
+        "eventType": hook["eventType"],
+        "publisherInputs": {"projectId": hook["publisherInputs"]["projectId"]},
+    }
+
+
+def _retry_delay(response, attempt):
+    """Seconds to wait before retrying a throttled request, from Retry-After or exponential backoff."""
+    retry_after = response.headers.get("Retry-After")
+    delay = None
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after)
+                delay = retry_at.timestamp() - time.time()
+            except (TypeError, ValueError):
+                pass
+    if delay is None:
+        delay = 2**attempt + random.random()
+    return min(max(delay, 0), MAX_RETRY_DELAY)
+
+
+@functools.lru_cache(maxsize=None)
+def _progress_bar(filled_length, length, fill):
+    return fill * filled_length + "-" * (length - filled_length)
+
+
 def progress(iteration, total, prefix="", suffix="", length=30, fill="#"):
-    percent = ("{0:.1f}").format(100 * (iteration / float(total)))
-    filled_length = int(length * iteration // total)
-    bar = fill * filled_length + "-" * (length - filled_length)
-    sys.stdout.write(f"\r{prefix} |{bar}| {percent}% {suffix}{' ' * 30}")
+    percent = 100 * iteration / total
+    bar = _progress_bar(int(length * iteration // total), length, fill)
+    sys.stdout.write(f"\r{prefix} |{bar}| {percent:.1f}% {suffix}{' ' * 30}")
     sys.stdout.flush()
 
 